@@ -1,7 +1,8 @@
-from .gcodepause import GCodeFile
+from .gcodepause import GCodeFile, insert_pauses_streaming
 
 __version__ = '0.1.0'
 
 all = [
     'GCodeFile',
+    'insert_pauses_streaming',
     ]
\ No newline at end of file
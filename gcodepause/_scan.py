@@ -0,0 +1,58 @@
+"""Scanning of whole G-code buffers for layer changes."""
+import re
+from array import array
+
+# A layer change is a ';<height>' comment line. The patterns start with the newline ending the
+# previous line so that the regex engine can jump between candidates with a literal search.
+# The same layer grammar is matched line by line by _layer_height in gcodepause.py; keep both in
+# sync.
+_LAYER = r'\n;([0-9]+\.?[0-9]*)\r?(?=\n|\Z)'
+_LAYER_RE = re.compile(_LAYER)
+_LAYER_RE_BYTES = re.compile(_LAYER.encode())
+
+def iter_layers(buf):
+    """Yields the height, start offset and end offset of each layer change line in a buffer.
+
+    The buffer may be a str or any bytes-like object, including an mmap. The end offset is
+    that of the line break ending the layer change line.
+    """
+    if isinstance(buf, str):
+        pattern, newline = _LAYER_RE, '\n'
+    else:
+        pattern, newline = _LAYER_RE_BYTES, b'\n'
+
+    # Prepending a newline lets the first line match like the others
+    end = buf.find(newline)
+    first = pattern.match(newline + (buf[:end] if end >= 0 else buf))
+    if first is not None:
+        yield float(first.group(1)), 0, first.end() - 1
+
+    for match in pattern.finditer(buf):
+        yield float(match.group(1)), match.start() + 1, match.end()
+
+def scan_layers(buf):
+    """Finds the layer changes in a buffer holding a whole G-code file.
+
+    Parameters
+    ----------
+    buf : str or bytes
+        The content of the G-code file.
+
+    Returns
+    -------
+    heights, line_nums : array
+        The heights of the layers and the corresponding line numbers (zero index), sorted by
+        height. Only the first line of each height is kept.
+    """
+    newline = '\n' if isinstance(buf, str) else b'\n'
+
+    layers = {}
+    line_num, pos = 0, 0
+    for height, start, _ in iter_layers(buf):
+        line_num += buf.count(newline, pos, start)
+        pos = start
+        if height not in layers:
+            layers[height] = line_num
+
+    heights = sorted(layers)
+    return array('d', heights), array('q', (layers[h] for h in heights))
@@ -1,10 +1,32 @@
-import re
+import locale
+import mmap
+import os
+from array import array
+from bisect import bisect_left
 from collections import OrderedDict
+from contextlib import closing
+from functools import lru_cache
 from pathlib import Path
+from string import Formatter
 from warnings import warn
 
 import yaml
 
+from ._scan import iter_layers, scan_layers
+
+try:
+    from yaml import CSafeLoader as _YamlLoader
+except ImportError:
+    from yaml import SafeLoader as _YamlLoader
+
+# Above this number of lines, the layers are found by scanning the joined content of blocks of
+# lines rather than line by line
+_SCAN_MIN_LINES = 10000
+_SCAN_CHUNK_LINES = 65536
+
+# Number of lines joined into each write when writing a file
+_WRITE_CHUNK_LINES = 65536
+
 template = []
 template.append(";BEGIN_PAUSE\n")
 template.append("G91    ; Put in relative mode\n")
@@ -15,8 +37,124 @@ template.append("M117 {message}    ; Diplay message to user\n")
 template.append("M0     ; Pause and wait for the user\n")
 template.append(";END_PAUSE\n")
 
+def _layer_height(line):
+    """Returns the height of a layer change comment line (e.g. ';4.2') or None if the line is not
+    a layer change.
+
+    The same layer grammar is matched by the _LAYER pattern in _scan.py; keep both in sync."""
+    line = line.rstrip('\r\n')
+    if line.startswith(';') and len(line) > 1:
+        body = line[1:]
+        # Same as the ;[0-9]+\.?[0-9]* pattern: ASCII digits only, with at most one '.' and not
+        # as the first character
+        if body[0] != '.' and body.count('.') <= 1 and not body.strip('0123456789.'):
+            return float(body)
+    return None
+
+@lru_cache(maxsize=16)
+def _field_lines(template):
+    """Returns the indices of the pause template lines that contain replacement fields to be
+    formatted. Each template is parsed only once."""
+    return tuple(i for i, line in enumerate(template)
+                 if any(field is not None for _, field, _, _ in Formatter().parse(line)))
+
+# typed=True keeps e.g. messages 1, 1.0 and True, which compare equal, from sharing an entry
+@lru_cache(maxsize=128, typed=True)
+def _build_pause(template, z_offset, x_pause, y_pause, message):
+    """Returns a tuple of the pause template lines formatted with the pause parameters. The
+    template is passed as a tuple so that the result can be cached."""
+    if z_offset <= 0:
+        raise ValueError(f"z_offset must be greater than zero, got  {z_offset}")
+    if x_pause <= 0 or y_pause <= 0:
+        e = f"x_pause and y_pause must be greater than zero, got ({x_pause, y_pause})"
+        raise ValueError(e)
+
+    fields = dict(z_offset=z_offset, x_pause=x_pause, y_pause=y_pause, message=message)
+    text = list(template)
+    for i in _field_lines(template):
+        text[i] = template[i].format_map(fields)
+
+    return tuple(text)
+
+def _pause_text(template, z_offset=10, x_pause=10, y_pause=10, message=None):
+    """Returns a tuple of lines to be inserted into the file, following the pause template.
+
+    The parameters are always passed positionally to the cached _build_pause so that equivalent
+    calls share a cache entry. The message is converted to the str that formatting it would give,
+    so that unhashable values such as YAML lists can be used as cache keys."""
+    return _build_pause(tuple(template), z_offset, x_pause, y_pause, str(message))
+
+def insert_pauses_streaming(in_file, out_file, pauses):
+    """Inserts pauses in a GCODE file while copying it to a new file.
+
+    Unlike GCodeFile, the source file is memory mapped and copied to the new file as is between
+    the pauses, without being split into lines, which makes this function better suited to very
+    large files when pauses only need to be added.
+
+    Parameters
+    ----------
+    in_file : str
+        The filename of the source GCODE file, including its path if not in the current
+        directory.
+
+    out_file : str
+        The filename of the file in which to write the modified GCODE.
+
+    pauses : dict
+        A dict mapping the heights of the layers at which to insert pauses to dicts of the
+        pause parameters (z_offset, x_pause, y_pause and message), as in a pauses YAML file.
+        Layer changes are expected to appear in increasing height order in the source file;
+        otherwise a warning is issued, as each pause is inserted at the first layer in file
+        order at or above its height, which may differ from GCodeFile.insert_pause.
+
+    Returns
+    -------
+    None
+    """
+    pending = sorted(pauses.items(), key=lambda p: p[0])
+    seen = set()
+    top, ordered = None, True
+    encoding = locale.getpreferredencoding(False)
+
+    with open(in_file, 'rb') as f_in, open(out_file, 'wb') as f_out:
+        if os.fstat(f_in.fileno()).st_size > 0:
+            with mmap.mmap(f_in.fileno(), 0, access=mmap.ACCESS_READ) as buf, \
+                    memoryview(buf) as view, closing(iter_layers(buf)) as layers:
+                pos = 0
+                for height, _, end in layers:
+                    if not pending and not ordered:
+                        break
+                    if height in seen:
+                        continue
+                    seen.add(height)
+                    if top is not None and height < top:
+                        if ordered:
+                            warn(f"Layer {height} follows the higher layer {top}; pauses may "
+                                 "not be inserted at the same layers as with GCodeFile.")
+                        ordered = False
+                    else:
+                        top = height
+                    if pending and pending[0][0] <= height:
+                        # Copy everything up to and including the layer change line as is
+                        newline = '\r\n' if buf[end - 1:end] == b'\r' else '\n'
+                        end = min(end + 1, len(buf))
+                        f_out.write(view[pos:end])
+                        pos = end
+                    while pending and pending[0][0] <= height:
+                        z, params = pending.pop(0)
+                        if z != height:
+                            warn(f"No layer found at {z}; using the next higher layer ({height}).")
+                        text = ''.join(_pause_text(template, **params))
+                        f_out.write(text.replace('\n', newline).encode(encoding))
+                f_out.write(view[pos:])
+
+    for z, _ in pending:
+        warn(f"{z} is above all layers.")
+
 class GCodeFile():
 
+    __slots__ = ('in_file', 'pause_template', 'lines', 'pauses', '_layer_heights', '_layer_lines')
+
     def __init__(self, file):
         """A class that allows insertion and removal of pauses in a 3D printing GCODE file.
         
@@ -31,11 +169,12 @@ class GCodeFile():
         self : GCodeFile
             A GCodeFile object representing the source GCODE file.
         """
-        if Path(file).is_file() and Path(file).suffix == '.gcode':
-            self.in_file = Path(file)
+        path = Path(file)
+        if path.suffix == '.gcode' and path.is_file():
+            self.in_file = path
         else:
             raise FileNotFoundError(f"{file} is not a valid file")
-        self.pause_template = template
+        self.pause_template = list(template)
         self.lines  = self._read_file()
         self._find_layers(self.lines)
         self._find_pauses(self.lines)
@@ -45,62 +184,75 @@ class GCodeFile():
         with open(self.in_file, 'r') as file:
             return file.readlines()
 
+    @property
+    def layers(self):
+        """An OrderedDict of the layer heights and their line numbers (zero index), in file
+        order."""
+        return OrderedDict(sorted(zip(self._layer_heights, self._layer_lines),
+                                  key=lambda layer: layer[1]))
+
     def _find_layers(self, lines):
-        """Finds the layer changes in the file and the corresponding line numbers (zero index)."""
-        layers = OrderedDict()
-
-        for line_num, line in enumerate(lines):
-            line = line.strip('\n').strip('\r')
-            if re.match(r'\A(;[0-9]+\.*[0-9]*){1}\Z', line):
-                height = float(line.strip(';'))
-                if height not in layers:
-                    layers[height] = line_num
+        """Finds the layer changes in the file and the corresponding line numbers (zero index).
+
+        The layers are stored as two parallel arrays sorted by height."""
+        layers = {}
+
+        if len(lines) > _SCAN_MIN_LINES:
+            # Blocks are joined one at a time so that peak memory grows by at most one block
+            for i in range(0, len(lines), _SCAN_CHUNK_LINES):
+                heights, line_nums = scan_layers(''.join(lines[i:i + _SCAN_CHUNK_LINES]))
+                for height, line_num in zip(heights, line_nums):
+                    if height not in layers:
+                        layers[height] = line_num + i
+        else:
+            for line_num, line in enumerate(lines):
+                # Most G-code lines are commands; only comment lines can be layer changes
+                if line[:1] == ';':
+                    height = _layer_height(line)
+                    if height is not None and height not in layers:
+                        layers[height] = line_num
         
-        self.layers = layers
+        heights = sorted(layers)
+        self._layer_heights = array('d', heights)
+        self._layer_lines = array('q', (layers[h] for h in heights))
 
     def _find_pauses(self, lines):
         """Find the pause blocks in the file and the corresponding line numbers (zero index)"""
-        pauses = OrderedDict()
+        pauses = []
+        sentinel = self.pause_template[0].rstrip('\r\n')
+        length = len(self.pause_template)
 
-        for line_num, line in enumerate(lines):
-            line = line.strip('\n').strip('\r')
-            if re.match(self.pause_template[0].strip('\n').strip('\r'), line):
-                height = {l: h for h, l in self.layers.items()}[line_num - 1]
-                pauses[height] = line_num, line_num + len(self.pause_template) - 1
+        # Pauses are only ever inserted right after a layer change line
+        for height, line_num in zip(self._layer_heights, self._layer_lines):
+            start = line_num + 1
+            if start < len(lines) and lines[start].rstrip('\r\n') == sentinel:
+                pauses.append((height, (start, start + length - 1)))
 
-        self.pauses = pauses
+        self.pauses = OrderedDict(sorted(pauses, key=lambda p: p[1]))
 
+    def _shift_lines(self, line_num, delta):
+        """Shifts the line numbers of the layers and pauses located at or after line_num by delta."""
+        self._layer_lines = array('q', (l + delta if l >= line_num else l
+                                        for l in self._layer_lines))
+        self.pauses = OrderedDict((h, (s + delta, e + delta) if s >= line_num else (s, e))
+                                  for h, (s, e) in self.pauses.items())
 
     def _get_layer(self, z):
         """Returns the line number matching a given layer height or the next higer layer if no
         layer exists at the given height."""
-        if z in self.layers:
-            return self.layers.get(z)
-        else:
-            layers = [height for height in sorted(self.layers.keys()) if height > z]
-            if len(layers) > 0:
-                warn(f"No layer found at {z}; using the next higher layer ({layers[0]}).")
-                return self.layers.get(layers[0])
-            else:
-                warn(f"{z} is above all layers.")
-                return None
-
-    def _get_pause_text(self, z_offset, x_pause, y_pause, message):
-        """Returns a list of lines to be inserted into the file."""
-        text = self.pause_template[:]
-        
-        if z_offset > 0:
-            text[2] = text[2].format(z_offset=z_offset)
-        else:
-            raise ValueError(f"z_offset must be greater than zero, got  {z_offset}")
-        if x_pause > 0 and y_pause > 0:
-            text[4] = text[4].format(x_pause=x_pause, y_pause=y_pause)
+        i = bisect_left(self._layer_heights, z)
+        if i < len(self._layer_heights):
+            if self._layer_heights[i] != z:
+                height = self._layer_heights[i]
+                warn(f"No layer found at {z}; using the next higher layer ({height}).")
+            return self._layer_lines[i]
         else:
-            e = f"x_pause and y_pause must be greater than zero, got ({x_pause, y_pause})"
-            raise ValueError(e)
-        text[5] = text[5].format(message=message)
+            warn(f"{z} is above all layers.")
+            return None
 
-        return text
+    def _get_pause_text(self, z_offset=10, x_pause=10, y_pause=10, message=None):
+        """Returns a tuple of lines to be inserted into the file, following the pause template."""
+        return _pause_text(self.pause_template, z_offset, x_pause, y_pause, message)
 
     def insert_pause(self, z, z_offset=10, x_pause=10, y_pause=10, message=None):
         """Inserts a pause at the begining of the layer at a specified height.
@@ -136,9 +288,12 @@ class GCodeFile():
             insert_line += 1
 
             pause_template = self._get_pause_text(z_offset, x_pause, y_pause, message)
-            self.lines = self.lines[:insert_line] + pause_template + self.lines[insert_line:]
-            self._find_layers(self.lines)
-            self._find_pauses(self.lines)
+            self.lines[insert_line:insert_line] = pause_template
+
+            height = self._layer_heights[self._layer_lines.index(insert_line - 1)]
+            self._shift_lines(insert_line, len(pause_template))
+            self.pauses[height] = insert_line, insert_line + len(pause_template) - 1
+            self.pauses = OrderedDict(sorted(self.pauses.items(), key=lambda p: p[1]))
 
     def insert_pauses_from_yaml(self, file):
         """Inserts one or more pauses as defined in a YAML file.
@@ -153,12 +308,30 @@ class GCodeFile():
         -------
         None
         """
-        if Path(file).is_file():
-            with open(Path(file), 'r') as f:
-                pauses = OrderedDict(yaml.load(f, Loader=yaml.Loader))
+        path = Path(file)
+        if path.is_file():
+            with open(path, 'r') as f:
+                pauses = OrderedDict(yaml.load(f, Loader=_YamlLoader))
 
+            # Resolve all insertion points against the current layers, then splice every pause
+            # block in a single pass over the lines
+            blocks = []
             for height, params in pauses.items():
-                self.insert_pause(height, **params)
+                insert_line = self._get_layer(height)
+                if insert_line is not None:
+                    blocks.append((insert_line + 1, self._get_pause_text(**params)))
+            blocks.sort(key=lambda b: b[0])
+
+            lines, cursor = [], 0
+            for insert_line, text in blocks:
+                lines.extend(self.lines[cursor:insert_line])
+                lines.extend(text)
+                cursor = insert_line
+            lines.extend(self.lines[cursor:])
+
+            self.lines = lines
+            self._find_layers(self.lines)
+            self._find_pauses(self.lines)
         else:
             raise FileNotFoundError(f"{file} is not a valid file")
     
@@ -176,9 +349,9 @@ class GCodeFile():
         """
         if height in self.pauses:
             start, end = self.pauses[height]
-            self.lines = self.lines[:start] + self.lines[end + 1:]
-            self._find_layers(self.lines)
-            self._find_pauses(self.lines)
+            del self.lines[start:end + 1]
+            del self.pauses[height]
+            self._shift_lines(end + 1, start - end - 1)
         else:
             warn(f"No pause found at height of {height}")
 
@@ -202,7 +375,9 @@ class GCodeFile():
         if file is not None:
             file = Path(file)
         else:
-            file = Path(self.in_file)
-            file = file.parent.joinpath(Path(file.stem + suffix + file.suffix))
+            file = self.in_file
+            file = file.with_name(file.stem + suffix + file.suffix)
+        # Join the lines in blocks to limit the number of writes without doubling peak memory
         with open(file, 'w') as f:
-            f.writelines(self.lines)
+            for i in range(0, len(self.lines), _WRITE_CHUNK_LINES):
+                f.write(''.join(self.lines[i:i + _WRITE_CHUNK_LINES]))
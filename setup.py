@@ -9,6 +9,6 @@ setup(
     url='https://github.com/DrGFreeman/GCode-Layer-Pause',
     license='MIT',
     python_requires='>=3.6',
-    install_requires=['pyyaml'],
+    install_requires=['pyyaml>=5.1'],
     packages=find_packages(),
 )